@@ -4,114 +4,435 @@
 # In[8]:
 
 
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
+from scipy.stats import hypergeom
+
+#Simulations are handed out to worker processes in batches of this size
+SIMULATION_BATCH_SIZE = 100
+
+#Version of the simulation algorithm, to be raised whenever a change makes cached power curves stale
+POWER_CACHE_VERSION = 1
+
+#Wilson score interval for a proportion of successes out of n trials
+def wilson_interval(successes, n, z=1.96):
+    if n == 0:
+        return 0.0, 1.0
+    proportion = successes / n
+    centre = (proportion + z**2 / (2 * n)) / (1 + z**2 / n)
+    half_width = z * np.sqrt(proportion * (1 - proportion) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+#Sizes of the batches for num_simulations: whole batches, then a shorter last one for the rest
+def batch_sizes(num_simulations):
+    full_batches, rest = divmod(num_simulations, SIMULATION_BATCH_SIZE)
+    return [SIMULATION_BATCH_SIZE] * full_batches + ([rest] if rest else [])
+
+#Significant count of one batch of simulations, run on its own random stream so it does not matter which process runs it
+def simulate_batch(trial, N, num_simulations, seed_sequence):
+    trial = copy.copy(trial)
+    trial.rng = np.random.default_rng(seed_sequence)
+    return trial.estimate_power(N, num_simulations)[0]
 
 #Defining class for the simulations
 class VeterinaryTrial:
     
     #Defining the initializing varibales
-    def __init__(self, pc, pv, alpha):
+    def __init__(self, pc, pv, alpha, seed=None, test='simulate'):
         self.pc = [1-pc, pc] #Probability of exposure before vaccination
         self.pv = [1-pv, pv] #Probability of exposure after vaccinatiom
         self.alpha = alpha #Significance percent
         self.outcomes = [0, 1] #Possible outcomes, 0 for not getting affected and 1 for getting affected
+        self.seed = seed #Seed for reproducible simulations
+        self.rng = np.random.default_rng(seed) #Random generator used for all the draws
+        self.seed_sequence = np.random.SeedSequence(seed) #Root of the per-batch random streams of the parallel mode
+        self.test = test #'simulate' for the permutation test, 'exact' for the exact hypergeometric test on binary outcomes
     
     #Defining the outcomes for N
     def probable_outcomes(self, N):
-        control_outcomes = np.random.choice(self.outcomes, size=N, p=self.pc) #Finding probable outcomes of control for the N considered
+        control_outcomes = self.rng.choice(self.outcomes, size=N, p=self.pc) #Finding probable outcomes of control for the N considered
         control_mean = np.mean(control_outcomes)
         
-        treatment_outcomes = np.random.choice(self.outcomes, size=N, p=self.pv) #Finding probable outcomes of treatment for the N considered
+        treatment_outcomes = self.rng.choice(self.outcomes, size=N, p=self.pv) #Finding probable outcomes of treatment for the N considered
         treatment_mean = np.mean(treatment_outcomes)
         
         initial_difference = treatment_mean - control_mean #Mean difference
         
         return control_outcomes, treatment_outcomes, initial_difference
 
-    #Defining function for randomizing the observed outcomes
-    def permutation_test(self, control_outcomes, treatment_outcomes, initial_difference):
-        num_permutations = 1000
-        
+    #Defining function for randomizing the observed outcomes, all permutations are drawn at once
+    def permutation_test(self, control_outcomes, treatment_outcomes, initial_difference, num_permutations=1000, test=None):
+        test = test or self.test
+        n_control = len(control_outcomes)
+        n_treatment = len(treatment_outcomes)
+
         #Combining control and treatment
         combined_outcomes = np.concatenate([control_outcomes, treatment_outcomes])
+        binary = np.isin(combined_outcomes, self.outcomes).all()
+
+        if test == 'exact':
+            if not binary:
+                raise ValueError("The exact test needs outcomes of 0 and 1. Use test='simulate' instead.")
+            return self.exact_test(control_outcomes, treatment_outcomes, initial_difference)
+        elif test != 'simulate':
+            raise ValueError("Invalid test provided. Use only simulate or exact.")
+
+        if binary:
+            #Binary outcomes: the number of affected animals landing in the permuted treatment group is hypergeometric
+            total_affected = int(combined_outcomes.sum())
+            treated_affected = self.rng.hypergeometric(total_affected, len(combined_outcomes) - total_affected, n_treatment, size=num_permutations)
+            final_differences = treated_affected / n_treatment - (total_affected - treated_affected) / n_control
+        else:
+            #Any other outcomes: one row per permutation of the combined observed outcomes
+            permuted_outcomes = self.rng.permuted(np.tile(combined_outcomes, (num_permutations, 1)), axis=1)
+            final_differences = permuted_outcomes[:, n_control:].mean(axis=1) - permuted_outcomes[:, :n_control].mean(axis=1)
 
-        final_differences = []
-
-        for i in range(num_permutations):
-            np.random.shuffle(combined_outcomes) #Randomizing the combined observed outcomes
-            
-            permuted_control_outcomes = combined_outcomes[:len(control_outcomes)] #Splitting one set as control outcome
-            p_control_mean = np.mean(permuted_control_outcomes)
-            
-            permuted_treatment_outcomes = combined_outcomes[len(control_outcomes):] #And the rest as treatment outcome
-            p_treated_mean = np.mean(permuted_treatment_outcomes)
-            
-            permuted_difference = p_treated_mean - p_control_mean #Checking for mean difference of the permuted set
-            
-            final_differences.append(permuted_difference)
-
-        num_greater_or_equal = np.sum(np.abs(final_differences) >= np.abs(initial_difference))
-        p_value = num_greater_or_equal / len(final_differences) #Calculating p-value based on mean difference from observed and permuted outcomes
+        p_value = np.mean(np.abs(final_differences) >= np.abs(initial_difference)) #Calculating p-value based on mean difference from observed and permuted outcomes
         return p_value
 
-    #Defining function for checking N
-    def find_optimal_N(self, confidence_range, max_N=1000):
+    #Exact two-sided p-value of the permutation test from the 2x2 table of group vs affected (Fisher-style)
+    def exact_test(self, control_outcomes, treatment_outcomes, initial_difference):
+        n_control = len(control_outcomes)
+        n_treatment = len(treatment_outcomes)
+        total_affected = int(np.sum(control_outcomes) + np.sum(treatment_outcomes))
+
+        #Every possible count of affected animals in the treatment group and its hypergeometric probability
+        treated_affected = np.arange(max(0, total_affected - n_control), min(total_affected, n_treatment) + 1)
+        probabilities = hypergeom.pmf(treated_affected, n_control + n_treatment, total_affected, n_treatment)
+
+        #Adding up the tables whose mean difference is at least as extreme as the observed one
+        differences = treated_affected / n_treatment - (total_affected - treated_affected) / n_control
+        p_value = np.sum(probabilities[np.abs(differences) >= np.abs(initial_difference)])
+        return min(p_value, 1.0)
+
+    #Running the simulations for N and counting how many of them are significant.
+    #With a confidence_range the simulations stop early once the power is confidently on one side of it.
+    def estimate_power(self, N, num_simulations=1000, confidence_range=None, check_every=50, stopping_z=2.576):
+        significant_count = 0
+        
+        #Passing each value of N in the fucntion
+        for simulation in range(1, num_simulations + 1):
+            control_outcomes, treatment_outcomes, initial_difference = self.probable_outcomes(N)
+            p_value = self.permutation_test(control_outcomes, treatment_outcomes, initial_difference)
+
+            if p_value < self.alpha: #Checking if p-value is above the significance level
+                significant_count += 1
+
+            #Sequential check with a stricter (99%) Wilson interval, as it is looked at repeatedly
+            if confidence_range is not None and simulation % check_every == 0 and simulation < num_simulations:
+                low, high = wilson_interval(significant_count, simulation, stopping_z)
+                if high < confidence_range or low >= confidence_range:
+                    return significant_count, simulation
+
+        return significant_count, num_simulations
+
+    #Random streams for batches first_batch, first_batch + 1, ... of N, spawned from the root seed
+    def batch_seeds(self, N, first_batch, n_batches):
+        return np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=(N,)).spawn(first_batch + n_batches)[first_batch:]
+
+    #Sending the simulation batches for N to the process pool (None for the batches already in the cache)
+    def submit_batches(self, N, num_simulations, executor, first_batch=0, cache=None):
+        sizes = batch_sizes(num_simulations)
+        seeds = self.batch_seeds(N, first_batch, len(sizes))
+        n_cached = len(cache.get(N, [])) if cache is not None else 0
+        return [None if first_batch + i < n_cached and size == SIMULATION_BATCH_SIZE else executor.submit(simulate_batch, self, N, size, seed)
+                for i, (size, seed) in enumerate(zip(sizes, seeds))]
+
+    #Same as estimate_power, but in batches of SIMULATION_BATCH_SIZE simulations that each have their own random stream
+    #(a shorter last batch covers the rest). For a given seed the result is the same whether the batches run here or in
+    #any number of worker processes. With a cache ({N: significant count of batch 0, 1, ...}) only the batches missing
+    #from it are simulated, and new ones are added to it; a shorter last batch is never cached, as it is only part of one.
+    def estimate_power_batched(self, N, num_simulations=1000, confidence_range=None, executor=None, first_batch=0,
+                               futures=None, stopping_z=2.576, cache=None):
+        sizes = batch_sizes(num_simulations)
+        if futures is None and executor is not None:
+            futures = self.submit_batches(N, num_simulations, executor, first_batch, cache)
+        seeds = self.batch_seeds(N, first_batch, len(sizes))
+        cached_counts = cache.setdefault(N, []) if cache is not None else None
+
+        significant_count = 0
+        simulations_used = 0
+        for batch, size in enumerate(sizes):
+            index = first_batch + batch
+            full_batch = size == SIMULATION_BATCH_SIZE
+            if cached_counts is not None and index < len(cached_counts) and full_batch:
+                count = cached_counts[index]
+            elif futures is None:
+                count = simulate_batch(self, N, size, seeds[batch])
+            else:
+                count = futures[batch].result()
+            if cached_counts is not None and index == len(cached_counts) and full_batch:
+                cached_counts.append(count)
+            significant_count += count
+            simulations_used += size
+
+            #Same sequential check as estimate_power, after every batch in order
+            if confidence_range is not None and batch < len(sizes) - 1:
+                low, high = wilson_interval(significant_count, simulations_used, stopping_z)
+                if high < confidence_range or low >= confidence_range:
+                    break
+
+        #Batches after an early stop are not needed any more
+        if futures is not None:
+            for future in futures[batch + 1:]:
+                if future is not None:
+                    future.cancel()
+        return significant_count, simulations_used
+
+    #File of the on-disk power cache for this trial, named after everything the simulated counts depend on
+    def power_cache_file(self, cache_dir):
+        key = {'pc': self.pc[1], 'pv': self.pv[1], 'alpha': self.alpha, 'test': self.test, 'seed': self.seed,
+               'batch_size': SIMULATION_BATCH_SIZE, 'version': POWER_CACHE_VERSION}
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f'power_curve_{digest}.json'), key
+
+    #Reading the cached significant counts per N and batch, if there are any
+    def load_power_cache(self, cache_dir):
+        cache_file, key = self.power_cache_file(cache_dir)
+        if not os.path.exists(cache_file):
+            return {}
+        with open(cache_file, 'r') as f:
+            stored = json.load(f)
+        if stored['key'] != key:
+            return {}
+        return {int(N): counts for N, counts in stored['batches'].items()}
+
+    #Storing the counts of all N in one JSON file, swapped in with os.replace so a half-written file is never read back
+    def save_power_cache(self, cache_dir, cache):
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file, key = self.power_cache_file(cache_dir)
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump({'key': key, 'batches': {str(N): counts for N, counts in sorted(cache.items()) if counts}}, f)
+        os.replace(cache_file + '.tmp', cache_file)
+
+    #Defining function for checking N, returning (N values, confidences, confidence intervals) of the N evaluated,
+    #or None when no N up to max_N reaches the confidence range
+    def find_optimal_N(self, confidence_range, max_N=1000, search='linear', num_simulations=1000, early_stopping=False, workers=None,
+                       cache_dir=None):
+        self.simulations_used = {} #N -> number of simulations it took
+        stopping_range = confidence_range if early_stopping else None
+
+        if search not in ('linear', 'adaptive'):
+            raise ValueError("Invalid search provided. Use only linear or adaptive.")
+
+        #Cached counts are only valid for the seeded batches, which every seeded run uses whatever the number of workers
+        cache = None
+        if cache_dir is not None:
+            if self.seed is None:
+                raise ValueError("A seed is needed to cache power curves. Provide seed to VeterinaryTrial.")
+            cache = self.load_power_cache(cache_dir)
+
+        #Parallel mode: (N, batch) work units in a process pool, reproducible for the seed whatever the number of workers.
+        #The workers are forked, since 'spawn'/'forkserver' workers cannot import simulate_batch from the notebook
+        #(and would re-run its demo cell when it is run as a script).
+        fork_context = multiprocessing.get_context('fork')
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=fork_context) if workers and workers > 1 else nullcontext() as executor:
+                if search == 'adaptive':
+                    return self.adaptive_search(confidence_range, max_N, num_simulations, stopping_range=stopping_range,
+                                                executor=executor, cache=cache)
+                return self.linear_search(confidence_range, max_N, num_simulations, stopping_range, workers, executor, cache)
+        finally:
+            if cache is not None:
+                self.save_power_cache(cache_dir, cache)
+
+    #Power estimate for N. With a seed it always goes through the seeded batches, so the number of workers and the cache
+    #never change the result; self.rng is only used for an unseeded run without workers.
+    def power_estimate(self, N, num_simulations, stopping_range=None, executor=None, first_batch=0, futures=None, cache=None):
+        if self.seed is None and executor is None:
+            return self.estimate_power(N, num_simulations, stopping_range)
+        return self.estimate_power_batched(N, num_simulations, stopping_range, executor, first_batch, futures, cache=cache)
+
+    #Trying every N from 2 upwards until the confidence range is reached
+    def linear_search(self, confidence_range, max_N=1000, num_simulations=1000, stopping_range=None, workers=None, executor=None,
+                      cache=None):
         N_values = []
         p_values = []
+        intervals = []
+        submitted = {} #N -> futures of batches already sent to the pool
 
         for N in range(2, max_N + 1): #Maximum values to consider for N
-            num_simulations = 1000
-            significant_count = 0
-        
-            #Passing each value of N in the fucntion
-            for _ in range(num_simulations):
-                control_outcomes, treatment_outcomes, initial_difference = self.probable_outcomes(N)
-                p_value = self.permutation_test(control_outcomes, treatment_outcomes, initial_difference)
 
-                if p_value < self.alpha: #Checking if p-value is above the significance level
-                    significant_count += 1
+            #Sending the batches of the next few N together so that every worker has something to do
+            if executor is not None and N not in submitted:
+                n_batches = len(batch_sizes(num_simulations))
+                n_ahead = max(1, -(-2 * workers // n_batches))
+                for upcoming_N in range(N, min(N + n_ahead, max_N + 1)):
+                    submitted[upcoming_N] = self.submit_batches(upcoming_N, num_simulations, executor, cache=cache)
 
-            confidence = significant_count / num_simulations
+            significant_count, simulations_used = self.power_estimate(N, num_simulations, stopping_range, executor,
+                                                                      futures=submitted.pop(N, None), cache=cache)
+            self.simulations_used[N] = simulations_used
+            confidence = significant_count / simulations_used
 
             N_values.append(N)
             p_values.append(confidence)
+            intervals.append(wilson_interval(significant_count, simulations_used))
 
             if confidence >= confidence_range: #Checking if the observed value is higher than the confidence range
-                return N_values, p_values
+                for futures in submitted.values():
+                    for future in futures:
+                        if future is not None:
+                            future.cancel()
+                return N_values, p_values, intervals
+
+        return None #No N up to max_N reaches the confidence range
+
+    #Exponential search followed by bisection, relying on the power growing with N
+    def adaptive_search(self, confidence_range, max_N=1000, num_simulations=1000, max_rounds=2, stopping_range=None,
+                        executor=None, cache=None):
+        evaluated = {} #N -> (confidence, confidence interval)
+        self.simulations_used = {}
+
+        def reaches_range(N):
+            significant_count, simulations_used = self.power_estimate(N, num_simulations, stopping_range, executor, cache=cache)
+            interval = wilson_interval(significant_count, simulations_used)
+
+            #Doubling the simulations while the interval still straddles the confidence range
+            for _ in range(max_rounds):
+                if not interval[0] < confidence_range <= interval[1]:
+                    break
+                #The extra simulations start with the batch after the last one used, a shorter last batch included
+                extra_count, extra_used = self.power_estimate(N, simulations_used, None, executor,
+                                                              first_batch=-(-simulations_used // SIMULATION_BATCH_SIZE), cache=cache)
+                significant_count += extra_count
+                simulations_used += extra_used
+                interval = wilson_interval(significant_count, simulations_used)
+
+            confidence = significant_count / simulations_used
+            evaluated[N] = (confidence, interval)
+            self.simulations_used[N] = simulations_used
+            return confidence >= confidence_range
+
+        #Exponential search for the first N (2, 4, 8, ...) that reaches the confidence range
+        low, high = 1, None
+        N = 2
+        while high is None:
+            if reaches_range(N):
+                high = N
+            elif N == max_N:
+                return None #No N up to max_N reaches the confidence range
+            else:
+                low = N
+                N = min(2 * N, max_N)
 
-        return 'No significant N possible at the range provided'
+        #Bisection between the last N below and the first N above the confidence range
+        while high - low > 1:
+            middle = (low + high) // 2
+            if reaches_range(middle):
+                high = middle
+            else:
+                low = middle
+
+        N_values = sorted(evaluated)
+        p_values = [evaluated[N][0] for N in N_values]
+        intervals = [evaluated[N][1] for N in N_values]
+        return N_values, p_values, intervals
 
     #Plot for confidence vs N
-    def plot_confidence_vs_N(self, confidence_range, max_N=1000):
-        result = self.find_optimal_N(confidence_range, max_N)
-        if result:
-            N_values, p_values = result
-            plt.plot(N_values, p_values, label='Confidence vs. Sample Size')
+    def plot_confidence_vs_N(self, confidence_range, max_N=1000, search='linear', early_stopping=False, workers=None, cache_dir=None):
+        result = self.find_optimal_N(confidence_range, max_N, search, early_stopping=early_stopping, workers=workers, cache_dir=cache_dir)
+        if result is None:
+            print('No significant N possible at the range provided')
+            return None, None
+        else:
+            N_values, p_values, intervals = result
+
+            #The optimal N is the smallest evaluated N reaching the confidence range (the last one for the linear search)
+            optimal_index = next(i for i, confidence in enumerate(p_values) if confidence >= confidence_range)
+
+            if search == 'adaptive':
+                #Only the evaluated points, with their confidence intervals as error bars
+                intervals = np.array(intervals)
+                plt.errorbar(N_values, p_values, yerr=[np.array(p_values) - intervals[:, 0], intervals[:, 1] - np.array(p_values)],
+                             fmt='o-', capsize=3, label='Confidence vs. Sample Size')
+            else:
+                plt.plot(N_values, p_values, label='Confidence vs. Sample Size')
             plt.axhline(y=confidence_range, color='r', linestyle='--', label=f'confidence range({confidence_range})')
             plt.xlabel('Sample Size (N)')
             plt.ylabel('Confidence')
             plt.title('Confidence vs. Sample Size')
-            plt.axvline(x=N_values[-1], color='g', linestyle='--', label='Optimal N')
+            plt.axvline(x=N_values[optimal_index], color='g', linestyle='--', label='Optimal N')
             plt.legend()
             plt.show()
-            if p_values[-1] >= confidence_range:
-                return N_values[-1], p_values[-1]
+            return N_values[optimal_index], p_values[optimal_index]
+
+#Optimal N and power for a whole grid of scenarios in one vectorized run, using the exact test.
+#For every N one set of uniform draws is shared by all (pc, pv) pairs (common random numbers), and the
+#p-values are shared by all alpha and confidence range values, so each scenario is still simulated correctly.
+def run_scenario_grid(pcs, pvs, alphas, confidence_ranges, max_N=1000, num_simulations=1000, seed=None):
+    rng = np.random.default_rng(seed)
+    pairs = np.array([(pc, pv) for pc in pcs for pv in pvs], dtype=float)
+    alphas = np.asarray(alphas, dtype=float)
+    confidence_ranges = np.asarray(confidence_ranges, dtype=float)
+
+    #Optimal N (0 while not reached) and its power for every (pair, alpha, confidence range)
+    optimal_N = np.zeros((len(pairs), len(alphas), len(confidence_ranges)), dtype=int)
+    optimal_power = np.full(optimal_N.shape, np.nan)
+
+    for N in range(2, max_N + 1):
+        #Affected animals per simulation for every pair: an animal is affected when its uniform draw is below the probability
+        control_draws = rng.random((num_simulations, N))
+        treatment_draws = rng.random((num_simulations, N))
+        control_affected = (control_draws[None, :, :] < pairs[:, 0, None, None]).sum(axis=2)
+        treated_affected = (treatment_draws[None, :, :] < pairs[:, 1, None, None]).sum(axis=2)
+
+        #Exact two-sided p-value: tables with |2t - K| at least the observed one, computed once per distinct table
+        total_affected = control_affected + treated_affected
+        low = np.minimum(treated_affected, total_affected - treated_affected)
+        tables, inverse = np.unique(total_affected * (N + 1) + low, return_inverse=True)
+        table_total, table_low = np.divmod(tables, N + 1)
+        table_p = hypergeom.cdf(table_low, 2 * N, table_total, N) + hypergeom.sf(table_total - table_low - 1, 2 * N, table_total, N)
+        p_values = np.minimum(table_p, 1.0)[inverse.reshape(total_affected.shape)]
+
+        #Power for every (pair, alpha) and the scenarios that reach their confidence range first at this N
+        power = (p_values[:, None, :] < alphas[None, :, None]).mean(axis=2)
+        newly_reached = (optimal_N == 0) & (power[:, :, None] >= confidence_ranges[None, None, :])
+        optimal_N[newly_reached] = N
+        optimal_power[newly_reached] = np.broadcast_to(power[:, :, None], optimal_N.shape)[newly_reached]
+
+        if (optimal_N > 0).all():
+            break
+
+    #Tidy table, one row per scenario (optimal_N is missing when max_N was not enough)
+    pair_index, alpha_index, range_index = np.indices(optimal_N.shape).reshape(3, -1)
+    return pd.DataFrame({
+        'pc': pairs[pair_index, 0],
+        'pv': pairs[pair_index, 1],
+        'alpha': alphas[alpha_index],
+        'confidence_range': confidence_ranges[range_index],
+        'optimal_N': pd.Series(optimal_N.ravel(), dtype='Int64').mask(optimal_N.ravel() == 0),
+        'power': optimal_power.ravel()})
 
 pc = 0.5
 pv = 0.1
 alpha = 0.05
 confidence_range = 0.9
 
-simulator = VeterinaryTrial(pc, pv, alpha)
+simulator = VeterinaryTrial(pc, pv, alpha, seed=42)
 optimal_N, observed_p_value = simulator.plot_confidence_vs_N(confidence_range)
 
-print(f"Optimal N: {optimal_N}")
-print(f"Confidence observed: {observed_p_value*100}%")
+if optimal_N is not None:
+    print(f"Optimal N: {optimal_N}")
+    print(f"Confidence observed: {observed_p_value*100}%")
 
 
 # In[ ]:
 
 
+#Grid of trial designs evaluated together
+scenario_table = run_scenario_grid(pcs=[0.4, 0.5, 0.6], pvs=[0.1, 0.2], alphas=[0.01, 0.05], confidence_ranges=[0.8, 0.9], seed=42)
+scenario_table
+
+
 
 
@@ -4,28 +4,227 @@
 # In[1]:
 
 
+import json
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import matplotlib.pyplot as plt
 
-#Opening the .csv file
-Covid_Data = pd.read_csv('owid-covid-data.csv')
+#Rows of the .csv file read at a time, so only the selected rows of each chunk are kept in memory
+CHUNK_SIZE = 100000
+
+#Rows per row group of the Parquet cache, small enough that a country subset or a few dates only read a few of them
+CACHE_ROW_GROUP_SIZE = 20000
+
+def read_covid_csv(path, columns, countries=None, dates=None, start=None, end=None, chunksize=CHUNK_SIZE):
+
+    #Reading only location, date and the given count columns, keeping the rows of the given countries and dates
+    #The dates are compared as 'YYYY-MM-DD' strings before parsing, so only the kept rows are converted
+    dtypes = {'location': str, 'date': str}
+    dtypes.update({column: 'float32' for column in columns})
+    countries = set(countries) if countries is not None else None
+    dates = set(pd.to_datetime(dates).strftime('%Y-%m-%d')) if dates is not None else None
+    start = pd.Timestamp(start).strftime('%Y-%m-%d') if start is not None else None
+    end = pd.Timestamp(end).strftime('%Y-%m-%d') if end is not None else None
 
-#Selecting the neccessary columns
-Newcases = Covid_Data.loc[:,['location','date','new_cases']]
+    selected = []
+    for chunk in pd.read_csv(path, usecols=list(dtypes), dtype=dtypes, chunksize=chunksize):
+        keep = pd.Series(True, index=chunk.index)
+        if countries is not None:
+            keep &= chunk['location'].isin(countries)
+        if dates is not None:
+            keep &= chunk['date'].isin(dates)
+        if start is not None:
+            keep &= chunk['date'] >= start
+        if end is not None:
+            keep &= chunk['date'] <= end
+        selected.append(chunk[keep])
+
+    data = pd.concat(selected, ignore_index=True)
+    data['location'] = data['location'].astype('category')
+    data['date'] = pd.to_datetime(data['date'], format='%Y-%m-%d')
+    return data[['location', 'date'] + list(columns)]
+
+
+def csv_signature(path):
+
+    #Size and modification time of the .csv file, the cache is rebuilt whenever either changes
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def read_cache_columns(cache_file, path):
+
+    #Count columns in the cache, or None when there is no cache or it belongs to another version of the .csv file
+    if not os.path.exists(cache_file):
+        return None
+    metadata = pq.read_schema(cache_file).metadata or {}
+    stored = json.loads(metadata.get(b'covid_cache', b'{}'))
+    if stored.get('csv') != csv_signature(path):
+        return None
+    return stored['columns']
+
+
+def covid_cache_files(path):
+
+    #The two copies of the cache next to the .csv file: sorted by location for country series, by date for snapshots
+    base = os.path.splitext(path)[0]
+    return {'location': base + '.parquet', 'date': base + '.by_date.parquet'}
+
+
+def write_covid_cache(path, cache_files, columns):
+
+    #Typed copies of the .csv file, one sorted by location and date and one by date and location, so that the
+    #min/max statistics of the row groups let a country filter or a date filter skip all the row groups it does not need
+    data = read_covid_csv(path, columns)
+    metadata = {b'covid_cache': json.dumps({'csv': csv_signature(path), 'columns': list(columns)}).encode()}
+    for sort_key, cache_file in cache_files.items():
+        order = ['location', 'date'] if sort_key == 'location' else ['date', 'location']
+        table = pa.Table.from_pandas(data.sort_values(order, ignore_index=True), preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+
+        #Each copy is swapped in whole with os.replace; a copy left behind from an older .csv file fails the check on load
+        pq.write_table(table, cache_file + '.tmp', row_group_size=CACHE_ROW_GROUP_SIZE)
+        os.replace(cache_file + '.tmp', cache_file)
+
+
+def load_covid_data(path, columns, countries=None, dates=None, start=None, end=None, cache=True):
+
+    #Reading from the Parquet cache next to the .csv file, which is (re)built on the first load after the .csv file changes
+    #A request for columns the cache does not have rebuilds it with those columns added
+    if not cache:
+        return read_covid_csv(path, columns, countries, dates, start, end)
+
+    cache_files = covid_cache_files(path)
+    cached_columns = [read_cache_columns(cache_file, path) for cache_file in cache_files.values()]
+    if None in cached_columns or cached_columns[0] != cached_columns[1] or not set(columns) <= set(cached_columns[0]):
+        cached_columns = list(dict.fromkeys((cached_columns[0] or []) + list(columns)))
+        write_covid_cache(path, cache_files, cached_columns)
+
+    #Dates without countries (snapshots, date ranges of the world) are read from the copy sorted by date
+    by_date = countries is None and (dates is not None or start is not None or end is not None)
+    cache_file = cache_files['date' if by_date else 'location']
+
+    filters = []
+    if countries is not None:
+        filters.append(('location', 'in', list(countries)))
+    if dates is not None:
+        filters.append(('date', 'in', list(pd.to_datetime(dates))))
+    if start is not None:
+        filters.append(('date', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('date', '<=', pd.Timestamp(end)))
+    data = pd.read_parquet(cache_file, columns=['location', 'date'] + list(columns), filters=filters or None)
+    data['location'] = data['location'].cat.remove_unused_categories()
+    return data
+
+
+def covid_matrix(data, column):
+
+    #Date x country matrix of one column, built once so that a country series is a column and a date snapshot a row
+    matrix = data.pivot(index='date', columns='location', values=column)
+    matrix.columns = matrix.columns.astype(str)
+    return matrix
+
+
+def covid_snapshot(matrix, date, column):
+
+    #float32 values of the countries with data on one date, in the long format plotly expects
+    #A date the matrix does not have gives an empty frame instead of a KeyError
+    values = matrix.reindex([pd.Timestamp(date)]).iloc[0].dropna().astype('float32')
+    return values.rename(column).rename_axis('location').reset_index()
+
+
+def rolling_window_sums(values, window):
+
+    #Sums and counts of the reported (non NaN) values over the last window days, for all countries at once
+    #Differences of cumulative sums along the date axis, windows that are not complete yet are left as NaN
+    reported = ~np.isnan(values)
+    value_sums = np.zeros((values.shape[0] + 1, values.shape[1]))
+    count_sums = np.zeros((values.shape[0] + 1, values.shape[1]))
+    np.cumsum(np.where(reported, values, 0), axis=0, out=value_sums[1:])
+    np.cumsum(reported, axis=0, out=count_sums[1:])
+
+    sums = np.full(values.shape, np.nan)
+    counts = np.zeros(values.shape)
+    sums[window - 1:] = value_sums[window:] - value_sums[:-window]
+    counts[window - 1:] = count_sums[window:] - count_sums[:-window]
+    sums[counts == 0] = np.nan
+    return sums, counts
+
+
+def covid_indicators(matrix, population=None, window=7):
+
+    #Rolling sum and mean over window days, week over week growth and, with a population per country, the mean per million people
+    #matrix is a date x country matrix, its dates are filled in to whole days so that the window is in days
+    matrix = matrix.asfreq('D')
+    values = matrix.to_numpy(dtype=np.float64)
+    sums, counts = rolling_window_sums(values, window)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+        growth = np.full(values.shape, np.nan)
+        growth[window:] = sums[window:] / sums[:-window] - 1
+    growth[~np.isfinite(growth)] = np.nan
+
+    indicators = {f'{window}d_sum': sums, f'{window}d_mean': means, 'growth': growth}
+    if population is not None:
+        per_million = population.reindex(matrix.columns).to_numpy(dtype=np.float64) / 1e6
+        indicators[f'{window}d_mean_per_million'] = means / per_million
+
+    #One column per (indicator, country)
+    return pd.concat({name: pd.DataFrame(array.astype(np.float32), index=matrix.index, columns=matrix.columns)
+                      for name, array in indicators.items()}, axis=1)
+
+
+def minmax_decimate(x, y, n_bins):
+
+    #Keeping only the minimum and the maximum of each of n_bins consecutive buckets, in date order
+    #With one bucket per pixel the line looks the same, spikes included, but has at most 2 * n_bins points
+    n = len(y)
+    if n <= 2 * n_bins:
+        return x, y
+    bucket_size = -(-n // n_bins) #Rounding up, so the last bucket is the only one with padding
+    n_bins = -(-n // bucket_size)
+    buckets = np.full(n_bins * bucket_size, np.nan)
+    buckets[:n] = y
+    buckets = buckets.reshape(n_bins, bucket_size)
+
+    #A bucket with no data gives a NaN point, which keeps the gap in the line
+    lowest = np.where(np.isnan(buckets), np.inf, buckets).argmin(axis=1)
+    highest = np.where(np.isnan(buckets), -np.inf, buckets).argmax(axis=1)
+    indices = np.sort(np.stack([lowest, highest], axis=1), axis=1) + (np.arange(n_bins) * bucket_size)[:, None]
+    indices = np.minimum(indices.ravel(), n - 1)
+    return x[indices], y[indices]
 
 # Selecting 6 countries
 Countries = ['India', 'Argentina', 'Brazil', 'Denmark', 'Japan', 'Phillipines']
 
-# Subsetting the new cases for the selected 6 countries
-Countrywise = Newcases[Newcases['location'].isin(Countries)]
+# Reading the new cases for the selected 6 countries only, as one column per country
+Countrywise = load_covid_data('owid-covid-data.csv', ['new_cases', 'population'], countries=Countries)
+Newcases = covid_matrix(Countrywise, 'new_cases').reindex(columns=Countries)
+Population = Countrywise.groupby('location', observed=True)['population'].last()
+
+# 7-day averages, per million rates and week over week growth of the new cases
+Indicators = covid_indicators(Newcases, Population)
 
 # Creating a figure and axes
 fig, ax = plt.subplots(figsize=(10, 6))
 
+# Drawing each series at the resolution of the axes, one bucket per pixel (False draws every day)
+Decimate = True
+Dates = Indicators.index.to_numpy()
+Width = int(ax.get_window_extent().width)
+
 # Loop through the selected countries and plotting their data
 for i in Countries:
-    A = Countrywise[Countrywise['location'] == i]
-    ax.plot(A['date'], A['new_cases'], label=i)
+    Values = Indicators['7d_mean'][i].to_numpy()
+    if Decimate:
+        ax.plot(*minmax_decimate(Dates, Values, Width), label=i)
+    else:
+        ax.plot(Dates, Values, label=i)
 
 #Label for x-axis
 ax.set_xlabel('Date')
@@ -34,7 +233,7 @@ ax.set_xlabel('Date')
 ax.xaxis.set_major_locator(plt.MaxNLocator(15))
 
 #Label for y-axis
-ax.set_ylabel('New Cases')
+ax.set_ylabel('New Cases (7-day average)')
 
 #Title for the graph
 ax.set_title('COVID Cases by Country')
@@ -51,51 +250,46 @@ plt.show()
 
 import plotly.express as px
 
-# Filtering the data for the date range on 21 September 20203
-Newcases_2023 = Covid_Data[Covid_Data['date'] == '2023-09-21']
-
-# Filtering the data for the date range on 21 November 20200
-Newcases_2020 = Covid_Data[Covid_Data['date'] == '2020-11-21']
-
-# Create the world map for 2023
-fig_2023 = px.choropleth(Newcases_2023, 
-                    locations="location", 
-                    locationmode="country names",
-                    color="total_cases",
-                    color_continuous_scale='Jet',
-                    # Specifying a custom color range for comparison between 2020 and 2023
-                    range_color=(0, 10000000),
-                    hover_name="location",
-                    title="COVID cases as on 21 Sep 2023")
-
-#Setting the title at the middle
-fig_2023.update_layout(
-    title={
-        'y':0.9,
-        'x':0.5})
-
-#Plotting the graph for 2023
-fig_2023.show()
-
-# Create the world map for the 2023
-fig_2020 = px.choropleth(Newcases_2020, 
-                    locations="location", 
-                    locationmode="country names",
-                    color="total_cases",
-                    color_continuous_scale='Jet',
-                    # Specifying a custom color range for comparison between 2020 and 2023
-                    range_color=(0, 10000000),
-                    hover_name="location",
-                    title="COVID cases as on 21 Nov 2020")
-
-#Setting the title at the middle
-fig_2020.update_layout(
-    title={
-        'y':0.9,
-        'x':0.5})
-
-#Plotting the graph for 2020
-fig_2020.show()
+def covid_choropleth(matrix, dates, column, title, range_color):
+
+    #World map with a date slider, every frame is the snapshot of one date of the date x country matrix
+    #Dates without any data (missing from the matrix or all NaN) get no frame
+    snapshots = [covid_snapshot(matrix, date, column).assign(date=date.strftime('%Y-%m-%d')) for date in pd.to_datetime(dates)]
+    snapshots = [snapshot for snapshot in snapshots if len(snapshot)]
+    if not snapshots:
+        raise ValueError('None of the dates have data to plot.')
+    long_data = pd.concat(snapshots, ignore_index=True)
+
+    fig = px.choropleth(long_data,
+                        locations="location",
+                        locationmode="country names",
+                        color=column,
+                        animation_frame="date",
+                        color_continuous_scale='Jet',
+                        range_color=range_color,
+                        hover_name="location",
+                        title=title)
+
+    #Setting the title at the middle
+    fig.update_layout(
+        title={
+            'y':0.9,
+            'x':0.5})
+    return fig
+
+# Dates to compare, any number of them can be added to the slider
+Snapshot_dates = ['2020-11-21', '2023-09-21']
+
+# Reading the total cases on those dates only, as one row per date
+Covid_Data = load_covid_data('owid-covid-data.csv', ['total_cases'], dates=Snapshot_dates)
+Totalcases = covid_matrix(Covid_Data, 'total_cases')
+
+# Create the world map with a slider over the dates
+# Specifying a custom color range for comparison between 2020 and 2023
+fig_snapshots = covid_choropleth(Totalcases, Snapshot_dates, 'total_cases', "COVID cases by date", range_color=(0, 10000000))
+
+#Plotting the graph
+fig_snapshots.show()
 
 
 # In[ ]: